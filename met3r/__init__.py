@@ -1 +1 @@
-from .met3r import MEt3R
\ No newline at end of file
+from .met3r import MEt3R, MEt3ROutput
\ No newline at end of file
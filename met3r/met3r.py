@@ -3,8 +3,12 @@
 import sys
 import os
 import os.path as path
+import functools
+from collections import OrderedDict
+import shutil
+import tempfile
 
-from typing import Literal, Optional, Union
+from typing import Callable, Literal, NamedTuple, Optional, Union
 
 import torch
 
@@ -12,7 +16,7 @@ from torch import Tensor
 from torch.nn import Identity, functional as F
 from pathlib import Path
 from torch.nn import Module
-from jaxtyping import Float, Bool
+from jaxtyping import Float, Bool, Int
 from typing import Union, Tuple
 from einops import rearrange, repeat
 from torchvision.models.optical_flow import raft_large
@@ -67,6 +71,272 @@ def convert_to_buffer(module: torch.nn.Module, persistent: bool = True):
         delattr(module, name)
         module.register_buffer(name, value, persistent=persistent)
 
+def local_hub_checkout(repo: Union[str, Path]) -> Optional[Path]:
+    """Local checkout of a torch hub repo "owner/name[:ref]" as downloaded by an earlier `torch.hub.load`. Returns
+    None if the repo has not been downloaded yet.
+    """
+    if path.isdir(repo):
+        return Path(repo)
+
+    owner_name, _, ref = str(repo).partition(":")
+    pattern = f"{owner_name.replace('/', '_')}_{ref.replace('/', '_') if ref else '*'}"
+    for checkout in sorted(Path(torch.hub.get_dir()).glob(pattern)):
+        if (checkout / "hubconf.py").is_file():
+            return checkout
+
+    return None
+
+def load_featup(
+    weights: Union[str, Path], 
+    feature_backbone: str, 
+    use_norm: bool, 
+    cache_dir: Optional[Union[str, Path]] = None
+) -> Module:
+    """Load FeatUp from torch hub. If `cache_dir` is given, the state dict is stored locally after the first load and
+    later loads only build the architecture and memory-map the cached weights.
+    """
+    if cache_dir is None:
+        return torch.hub.load(weights, feature_backbone, use_norm=use_norm)
+
+    repo = str(weights).strip("/").replace("/", "_")
+    cache_path = Path(cache_dir) / f"featup_{repo}_{feature_backbone}{'_norm' if use_norm else ''}.pth"
+    if cache_path.is_file():
+        # NOTE: Loading the hubconf from the local checkout avoids resolving the repo on GitHub in every process
+        checkout = local_hub_checkout(weights)
+        if checkout is None:
+            featup = torch.hub.load(weights, feature_backbone, use_norm=use_norm, pretrained=False)
+        else:
+            featup = torch.hub.load(str(checkout), feature_backbone, source="local", use_norm=use_norm, pretrained=False)
+        featup.load_state_dict(torch.load(cache_path, map_location="cpu", mmap=True, weights_only=True))
+    else:
+        featup = torch.hub.load(weights, feature_backbone, use_norm=use_norm)
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        # NOTE: Write to a temporary file and move it into place so that concurrent or interrupted runs never see a 
+        # partial cache
+        fd, tmp_path = tempfile.mkstemp(dir=cache_path.parent, prefix=f".{cache_path.name}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                torch.save(featup.state_dict(), f)
+            os.replace(tmp_path, cache_path)
+        finally:
+            if path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    return featup
+
+def is_cached_backbone(local_dir: Path) -> bool:
+
+    return (local_dir / "model.safetensors").is_file() and (local_dir / "config.json").is_file()
+
+def load_backbone(model_cls: type, weights: str, cache_dir: Optional[Union[str, Path]] = None) -> Module:
+    """Load MASt3R/DUSt3R from huggingface. If `cache_dir` is given, the model is saved locally after the first load
+    and later loads read the local safetensors without contacting the hub.
+    """
+    if cache_dir is None:
+        return model_cls.from_pretrained(weights)
+
+    local_dir = Path(cache_dir) / weights.split("/")[-1]
+    if is_cached_backbone(local_dir):
+        return model_cls.from_pretrained(str(local_dir))
+
+    model = model_cls.from_pretrained(weights)
+    local_dir.parent.mkdir(parents=True, exist_ok=True)
+    # NOTE: Save to a temporary directory and move it into place so that concurrent or interrupted runs never see a 
+    # partial cache
+    tmp_dir = tempfile.mkdtemp(dir=local_dir.parent, prefix=f".{local_dir.name}.")
+    try:
+        model.save_pretrained(tmp_dir)
+        if local_dir.is_dir() and not is_cached_backbone(local_dir):
+            # Leftover of an incomplete save
+            shutil.rmtree(local_dir, ignore_errors=True)
+        try:
+            os.replace(tmp_dir, local_dir)
+        except OSError:
+            # Another process has completed the cache in the meantime
+            if not is_cached_backbone(local_dir):
+                raise
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return model
+
+@functools.lru_cache(maxsize=8)
+def centered_pixel_grid(h: int, w: int, device: Union[str, torch.device] = "cpu") -> Float[Tensor, "1 hw 2"]:
+    """Pixel coordinates relative to the principal point at the image center, flattened in row-major order. Results
+    are cached per resolution and device and must not be modified in place.
+    """
+    pp = torch.tensor([w / 2, h / 2], device=device)
+
+    return xy_grid(w, h, device=device).view(1, -1, 2) - pp.view(-1, 1, 2)
+
+def canonical_point_map(
+    ptmps: Float[Tensor, "b 2 h w 3"],
+    conf: Float[Tensor, "b 2 h w"],
+) -> Float[Tensor, "b h w 3"]:
+    """Confidence-weighted mean of the point maps of both views"""
+    # NOTE: Written out for the two views as elementwise ops, `einsum` would lower to a batched matmul over b*h*w
+    # tiny matrices after copying the point maps to a (b h w 2 3) layout
+    weights = conf - 0.999
+    w1, w2 = weights[:, 0, ..., None], weights[:, 1, ..., None]
+
+    return (w1 * ptmps[:, 0] + w2 * ptmps[:, 1]) / (w1 + w2).clamp_min(1e-6)
+
+def estimate_focal(
+    pts3d: Float[Tensor, "b hw 3"],
+    pixels: Float[Tensor, "b hw 2"],
+) -> Float[Tensor, "b 2"]:
+    """Focal lengths (fx, fy) as the least squares solution of (u, v) = (fx * x / z, fy * y / z) in pixel space, which
+    corresponds to the L2 initialization of `estimate_focal_knowing_depth` in DUSt3R per axis.
+    """
+    xy_over_z = (pts3d[..., :2] / pts3d[..., 2:]).nan_to_num(nan=0.0, posinf=0.0, neginf=0.0)
+
+    return (pixels * xy_over_z).sum(1) / xy_over_z.square().sum(1).clamp_min(1e-8)
+
+class EquisizedPointclouds(Pointclouds):
+    """Pointclouds with the same number of points in every cloud, constructed from padded tensors. Packed tensors are
+    reshaped views of the padded ones, which skips the conversion to lists done by Pytorch3D for heterogeneous batches.
+    """
+
+    def _compute_packed(self, refresh: bool = False):
+        if not (
+            refresh
+            or any(
+                v is None
+                for v in [
+                    self._points_packed,
+                    self._packed_to_cloud_idx,
+                    self._cloud_to_packed_first_idx,
+                ]
+            )
+        ):
+            return
+
+        N, P = self._N, self._P
+        cloud_idx = torch.arange(N, device=self.device)
+        self._points_packed = self._points_padded.reshape(N * P, 3)
+        self._cloud_to_packed_first_idx = cloud_idx * P
+        self._packed_to_cloud_idx = cloud_idx.repeat_interleave(P)
+        self._normals_packed = None if self._normals_padded is None else self._normals_padded.reshape(N * P, 3)
+        self._features_packed = None if self._features_padded is None else self._features_padded.reshape(N * P, -1)
+
+def drop_points(
+    points: Float[Tensor, "n p 3"],
+    keep: Bool[Tensor, "n p"],
+    features: Optional[Float[Tensor, "n p c"]] = None,
+    feature_index: Optional[Int[Tensor, "np"]] = None,
+) -> Tuple[
+        Pointclouds, 
+        Optional[Float[Tensor, "q c"]], 
+        Optional[Int[Tensor, "q"]]
+    ]:
+    """Heterogeneous point clouds of the points selected by `keep`, clouds without any kept point stay empty.
+    Features and feature indices of the kept points are returned in the packed order of the point clouds.
+    """
+    point_clouds = Pointclouds(points=list(points[keep].split(keep.sum(1).tolist())))
+    if features is not None:
+        features = features[keep]
+    if feature_index is not None:
+        feature_index = feature_index[keep.flatten()]
+
+    return point_clouds, features, feature_index
+
+def nearest_feature_index(
+    n: int, 
+    h: int, 
+    w: int, 
+    lr_h: int, 
+    lr_w: int, 
+    device: Union[str, torch.device] = "cpu"
+) -> Int[Tensor, "nhw"]:
+    """Rows of flattened (n lr_h lr_w) features which nearest upsampling to (h, w) assigns to each pixel of n images"""
+    rows = torch.arange(h, device=device) * lr_h // h
+    cols = torch.arange(w, device=device) * lr_w // w
+    pixel_index = (rows[:, None] * lr_w + cols[None, :]).flatten()
+    offsets = torch.arange(n, device=device)[:, None] * (lr_h * lr_w)
+
+    return (offsets + pixel_index[None]).flatten()
+
+def composite_points(
+    idx: Int[Tensor, "n h w k"],
+    dists: Float[Tensor, "n h w k"],
+    features: Float[Tensor, "p c"],
+    radius: float,
+    feature_index: Optional[Int[Tensor, "p"]] = None,
+) -> Float[Tensor, "n h w c"]:
+    """Front-to-back alpha compositing of rasterized point features. Equivalent to `AlphaCompositor` from Pytorch3D,
+    but written with plain tensor ops so that `torch.compile` can fuse it with the weight computation.
+
+    Args:
+        idx (Int[Tensor, "n h w k"]): Packed indices of the k closest points per pixel, -1 for empty slots
+        dists (Float[Tensor, "n h w k"]): Squared distances of the points to the pixel centers
+        features (Float[Tensor, "p c"]): Packed point features
+        radius (float): Point radius used for rasterization
+        feature_index (Int[Tensor, "p"], optional): Row of `features` for each packed point. Defaults to None to
+            use the point index directly.
+
+    Returns:
+        images (Float[Tensor, "n h w c"]): Composited feature images
+    """
+    alphas = (1 - dists / (radius * radius)) * (idx >= 0)
+    # Transmittance in front of each of the k points
+    transmittance = torch.cumprod(1 - alphas, dim=-1)
+    transmittance = torch.cat([torch.ones_like(transmittance[..., :1]), transmittance[..., :-1]], dim=-1)
+    weights = alphas * transmittance
+
+    idx = idx.clamp_min(0).long()
+    if feature_index is not None:
+        idx = feature_index[idx]
+    images = weights[..., 0, None] * features[idx[..., 0]]
+    for i in range(1, idx.shape[-1]):
+        images = images + weights[..., i, None] * features[idx[..., i]]
+
+    return images
+
+def cosine_score(
+    inp1: Float[Tensor, "b c h w"],
+    inp2: Float[Tensor, "b c h w"],
+    mask: Optional[Float[Tensor, "b h w"]] = None,
+    eps: float = 1e-5,
+) -> Tuple[
+        Float[Tensor, "b h w"], 
+        Optional[Float[Tensor, "b"]]
+    ]:
+    """Cosine dissimilarity along the channel dimension and its weighted mean over the mask. Kept in a single
+    function so that `torch.compile` can fuse the whole scoring into few kernels.
+
+    Args:
+        inp1 (Float[Tensor, "b c h w"]): First feature map
+        inp2 (Float[Tensor, "b c h w"]): Second feature map
+        mask (Float[Tensor, "b h w"], optional): Weights for the mean of the score map. Defaults to None.
+        eps (float, optional): Small value for numerical stability. Defaults to 1e-5.
+
+    Returns:
+        score_map (Float[Tensor, "b h w"]): Feature dissimilarity score map
+        weighted (Float[Tensor, "b"], optional): Weighted mean of the score map if `mask` is given
+    """
+    # NOTE: L2-normalizing both inputs once reduces the similarity to a single dot product
+    score_map = 1 - (F.normalize(inp1, dim=1, eps=eps) * F.normalize(inp2, dim=1, eps=eps)).sum(1)
+    if mask is None:
+        return score_map, None
+
+    weighted = (score_map * mask).sum((-2, -1)) / (mask.sum((-2, -1)) + eps)
+
+    return score_map, weighted
+
+class MEt3ROutput(NamedTuple):
+    """Outputs of MET3R. Optional outputs are None unless requested in `MEt3R.forward`
+
+    Args:
+        score (Float[Tensor, "b"]): MET3R score which consists of weighted mean of feature dissimlarity
+        overlap_mask (Float[Tensor, "b h w"], optional): Overlapping mask
+        score_map (Float[Tensor, "b h w"], optional): Feature dissimilarity score map
+        projections (Float[Tensor, "b 2 c h w"], optional): Projected and rendered features
+    """
+    score: Float[Tensor, "b"]
+    overlap_mask: Optional[Float[Tensor, "b h w"]] = None
+    score_map: Optional[Float[Tensor, "b h w"]] = None
+    projections: Optional[Float[Tensor, "b 2 c h w"]] = None
+
 backbone_to_weights = {
     "mast3r": "naver/MASt3R_ViTLarge_BaseDecoder_512_catmlpdpt_metric",
     "dust3r": "naver/DUSt3R_ViTLarge_BaseDecoder_512_dpt"
@@ -84,6 +354,17 @@ class MEt3R(Module):
         upsampler: Optional[Literal["featup", "nearest", "bilinear", "bicubic"]] = "featup",
         distance: Literal["cosine", "lpips", "rmse", "psnr", "mse", "ssim"] = "cosine",
         freeze: bool=True,
+        points_per_pixel: int = 4,
+        bin_size: Optional[int] = None,
+        use_compile: bool = False,
+        compile_backbones: bool = False,
+        compile_mode: Optional[str] = "max-autotune",
+        autocast_dtype: Optional[torch.dtype] = None,
+        feature_dtype: Optional[torch.dtype] = None,
+        cache_dir: Optional[Union[str, Path]] = None,
+        conf_threshold: Optional[float] = None,
+        use_cuda_graph: bool = False,
+        max_cuda_graphs: int = 4,
         rasterizer_kwargs: dict = {}
     ) -> None:
         """Initialize MET3R
@@ -96,6 +377,17 @@ class MEt3R(Module):
             upsampler (str, optional): Set upsampling types. Defaults to "featup".
             distance (str): Select which distance to compute. Default to "cosine" for computing feature dissimilarity.
             freeze (bool, optional): Set whether to freeze the model. Defaults to True.
+            points_per_pixel (int, optional): Number of points composited per pixel. The (N, H, W, K) fragment tensors scale linearly with it and dominate memory in `render()`. Note that MEt3R 1.0.1 composited 10 points per pixel, set to 10 to reproduce its scores as fewer points slightly change them. Defaults to 4.
+            bin_size (int, optional): Bin size for the coarse-to-fine rasterizer of PyTorch3D. Set to None to pick it heuristically, to a power of two to tune it manually, or to 0 to use the naive rasterizer. Defaults to None.
+            use_compile (bool, optional): Compile the canonical point map fusion, feature compositing and cosine scoring with `torch.compile`. Defaults to False.
+            compile_backbones (bool, optional): Compile the feature backbone, the upsampler and the warping backbone with `torch.compile`. Defaults to False.
+            compile_mode (str, optional): Mode passed to `torch.compile` for the backbones. Defaults to "max-autotune".
+            autocast_dtype (torch.dtype, optional): Run feature extraction and MASt3R/DUSt3R under CUDA autocast with this dtype, e.g. `torch.bfloat16`. Set to None to run in full precision. Defaults to None.
+            feature_dtype (torch.dtype, optional): Overrides `autocast_dtype` for feature extraction and upsampling only, e.g. to run FeatUp in `torch.bfloat16` while keeping MASt3R/DUSt3R in full precision. Defaults to None.
+            cache_dir (str | Path, optional): Local directory for caching pretrained weights of FeatUp and MASt3R/DUSt3R to speed up subsequent initializations. Defaults to None.
+            conf_threshold (float, optional): Only rasterize points with a MASt3R/DUSt3R confidence above this threshold. Note that confidences are at least 1. Set to None to keep all points. Defaults to None.
+            use_cuda_graph (bool, optional): Capture feature extraction and upsampling in a CUDA graph per input shape and replay it on subsequent calls. MASt3R/DUSt3R are not captured as their patch embedding and RoPE synchronize with the host. Only used with a fixed `img_size`, CUDA inputs and gradients disabled. Cannot be combined with `compile_backbones`. Defaults to False.
+            max_cuda_graphs (int, optional): Maximum number of captured CUDA graphs, one per input shape. Each graph keeps its own memory pool, so the least recently used graph is released once the limit is exceeded. Captured graphs are also released when the module is moved or on `clear_cuda_graphs()`. Defaults to 4.
             rasterizer_kwargs (dict): Additional argument for point cloud render from PyTorch3D. Default to an empty dict. 
         """
         super().__init__()
@@ -103,20 +395,37 @@ class MEt3R(Module):
         self.upsampler = upsampler
         self.backbone = backbone
         self.distance = distance
+        self.points_per_pixel = points_per_pixel
+        self.bin_size = bin_size
+        self.use_compile = use_compile
+        self.autocast_dtype = autocast_dtype
+        self.feature_dtype = feature_dtype if feature_dtype is not None else autocast_dtype
+        self.conf_threshold = conf_threshold
+        self.use_cuda_graph = use_cuda_graph
+        self.max_cuda_graphs = max_cuda_graphs
+        self._cuda_graphs = OrderedDict()
+        self._rasterizers = {}
+        if use_cuda_graph and compile_backbones:
+            raise ValueError("`use_cuda_graph` cannot be combined with `compile_backbones`. Set either of them to `False`")
+        if use_cuda_graph and max_cuda_graphs < 1:
+            raise ValueError("`max_cuda_graphs` must be at least 1 when using `use_cuda_graph=True`")
         if upsampler == "featup" and "FeatUp" not in feature_backbone_weights:
             raise ValueError("Need to specify the correct weight path on huggingface for using `upsampler=\"featup\"`. Set `feature_backbone_weights=\"mhamilton723/FeatUp\"`")
             
         if distance == "cosine":
+            self._cosine_score = torch.compile(cosine_score, dynamic=True) if use_compile else cosine_score
             if "FeatUp" in feature_backbone_weights:
                 # Load featup
-                from featup.util import norm, unnorm
-                self.norm = norm
+                # NOTE: ImageNet normalization of FeatUp is kept in buffers to avoid creating the tensors per call
+                self.register_buffer("_imnet_mean", torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1), persistent=False)
+                self.register_buffer("_imnet_std", torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1), persistent=False)
+                self.norm = self._imagenet_norm
                 if feature_backbone not in ["dino16", "dinov2", "maskclip", "vit", "clip", "resnet50"]:
                     raise ValueError("Provide `feature_backone` is not implemented for `FeatUp`. Please select from [\"dino16\", \"dinov2\", \"maskclip\", \"vit\", \"clip\", \"resnet50\"] in conjunction with `feature_backbone_weights=\"mhamilton723/FeatUp\"`")
                 if use_norm is None:
                     raise ValueError("When using `FeatUp`, specify `use_norm` as either `True` or `False`. Currently it is set to `None`")
                 
-                featup = torch.hub.load(feature_backbone_weights, feature_backbone, use_norm=use_norm)
+                featup = load_featup(feature_backbone_weights, feature_backbone, use_norm, cache_dir=cache_dir)
                 self.feature_model = featup.model
                 if upsampler == "featup":
                     self.upsampler_model = featup.upsampler
@@ -131,16 +440,21 @@ class MEt3R(Module):
             if freeze:
                 freeze_model(self.feature_model) 
                 convert_to_buffer(self.feature_model, persistent=False)
+
+            if compile_backbones:
+                self.feature_model = torch.compile(self.feature_model, mode=compile_mode)
+                if hasattr(self, "upsampler_model"):
+                    self.upsampler_model = torch.compile(self.upsampler_model, mode=compile_mode)
             
 
         
         
         if backbone == "mast3r":
             from mast3r.model import AsymmetricMASt3R 
-            self.backbone_model = AsymmetricMASt3R.from_pretrained(backbone_to_weights[backbone])
+            self.backbone_model = load_backbone(AsymmetricMASt3R, backbone_to_weights[backbone], cache_dir=cache_dir)
         elif backbone == "dust3r":
             from dust3r.model import AsymmetricCroCo3DStereo 
-            self.backbone_model = AsymmetricCroCo3DStereo.from_pretrained(backbone_to_weights[backbone])
+            self.backbone_model = load_backbone(AsymmetricCroCo3DStereo, backbone_to_weights[backbone], cache_dir=cache_dir)
         elif backbone == "raft":
             self.backbone_model = raft_large(pretrained=True, progress=False)
         else:
@@ -150,17 +464,31 @@ class MEt3R(Module):
             freeze_model(self.backbone_model) 
             convert_to_buffer(self.backbone_model, persistent=False)
 
+        if compile_backbones:
+            self.backbone_model = torch.compile(self.backbone_model, mode=compile_mode)
+
         if backbone in ["mast3r", "dust3r"]:
 
             if self.img_size is not None:
                 self.set_rasterizer(
                     image_size=img_size, 
-                    points_per_pixel=10,
-                    bin_size=0,
+                    points_per_pixel=points_per_pixel,
+                    bin_size=bin_size,
                     **rasterizer_kwargs
                 )
-            
-            self.compositor = AlphaCompositor()
+                self.register_buffer("_pixels", centered_pixel_grid(img_size, img_size).clone(), persistent=False)
+
+            # NOTE: Inlined compositing is only worth it when compiled, eager mode keeps the fused kernel of Pytorch3D
+            # `reduce-overhead` is avoided as its CUDA graph outputs are overwritten by subsequent calls
+            if use_compile:
+                self._composite = torch.compile(composite_points, dynamic=True)
+            else:
+                self.compositor = AlphaCompositor()
+            self._canonical_point_map = torch.compile(canonical_point_map, dynamic=True) if use_compile else canonical_point_map
+
+            # Constant camera pose for rendering which flips x and y to the Pytorch3D convention
+            self.register_buffer("_R_flip", torch.diag(torch.tensor([-1.0, -1.0, 1.0]))[None], persistent=False)
+            self.register_buffer("_T0", torch.zeros(1, 3), persistent=False)
         
         if distance == "lpips":
             self.lpips = LPIPS(spatial=True)
@@ -168,9 +496,10 @@ class MEt3R(Module):
     def _distance(self, inp1: Tensor, inp2: Tensor, mask: Optional[Tensor]=None, eps: float=1e-5):
 
         if self.distance == "cosine":
-            # Get feature dissimilarity score map
-            score_map = 1 - (inp1 * inp2).sum(1) / (torch.linalg.norm(inp1, dim=1) * torch.linalg.norm(inp2, dim=1) + eps) 
-            score_map = score_map[:, None]
+            # Get feature dissimilarity score map and its weighted mean
+            score_map, weighted = self._cosine_score(inp1, inp2, mask, eps)
+
+            return (score_map, ) if weighted is None else (score_map, weighted)
         elif self.distance == "mse":
             score_map = ((inp1 - inp2)**2).mean(1, keepdim=True)
         elif self.distance == "psnr":
@@ -199,20 +528,112 @@ class MEt3R(Module):
             # Important for specific backbone which may not return with correct dimensions
             feat = F.interpolate(feat, (inp2.shape[-2:]), mode="bilinear")
         else:
-
-            feat = F.interpolate(inp1, (inp2.shape[-2:]), mode=self.upsampler)
+            b, c, lr_h, lr_w = inp1.shape
+            h, w = inp2.shape[-2:]
+            if self.upsampler == "nearest" and h % lr_h == 0 and w % lr_w == 0:
+                # NOTE: Nearest upsampling with integer scales is a pure stride manipulation followed by a single copy
+                s_h, s_w = h // lr_h, w // lr_w
+                feat = inp1.permute(0, 2, 3, 1)[:, :, None, :, None, :].expand(-1, -1, s_h, -1, s_w, -1)
+                feat = feat.reshape(b, h, w, c).permute(0, 3, 1, 2)
+            else:
+                feat = F.interpolate(inp1, (inp2.shape[-2:]), mode=self.upsampler)
 
         return feat
     
+    def _imagenet_norm(self, images: Float[Tensor, "b 3 h w"]) -> Float[Tensor, "b 3 h w"]:
+
+        return (images - self._imnet_mean) / self._imnet_std
+
     def _get_features(self, images):
         
         return self.feature_model(self.norm(images))
 
+    def _run_graphed(self, key: str, fn: Callable[..., Tuple[Tensor, ...]], *inputs: Tensor) -> Tuple[Tensor, ...]:
+        """Run `fn` through a CUDA graph which is captured on the first call for the given input shapes
+
+        Args:
+            key (str): Name of the graphed stage
+            fn (Callable): Function of tensors returning a tuple of tensors
+            inputs (Tensor): Inputs to `fn`
+
+        Returns:
+            outputs (Tuple[Tensor, ...]): Outputs of `fn`
+        """
+        graph_key = (key, inputs[0].device, inputs[0].dtype, *(tuple(x.shape) for x in inputs))
+        if graph_key not in self._cuda_graphs:
+            static_inputs = tuple(x.clone() for x in inputs)
+
+            # Warm up on a side stream before capturing
+            stream = torch.cuda.Stream()
+            stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(stream):
+                for _ in range(3):
+                    fn(*static_inputs)
+            torch.cuda.current_stream().wait_stream(stream)
+
+            graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(graph):
+                static_outputs = fn(*static_inputs)
+            self._cuda_graphs[graph_key] = (graph, static_inputs, static_outputs)
+            while len(self._cuda_graphs) > self.max_cuda_graphs:
+                self._cuda_graphs.popitem(last=False)
+
+        self._cuda_graphs.move_to_end(graph_key)
+        graph, static_inputs, static_outputs = self._cuda_graphs[graph_key]
+        for static_x, x in zip(static_inputs, inputs):
+            static_x.copy_(x)
+        graph.replay()
+
+        return tuple(x.clone() for x in static_outputs)
+
+    def clear_cuda_graphs(self) -> None:
+        """Release all captured CUDA graphs together with their memory pools"""
+        self._cuda_graphs.clear()
+
+    def _apply(self, fn, *args, **kwargs):
+        # NOTE: Captured graphs refer to the memory of the previous device and dtype
+        self.clear_cuda_graphs()
+
+        return super()._apply(fn, *args, **kwargs)
+
+    def _compute_features(self, images: Float[Tensor, "b c h w"], upsample: bool = True) -> Tuple[Float[Tensor, "b c h w"]]:
+        with torch.autocast("cuda", dtype=self.feature_dtype, enabled=self.feature_dtype is not None):
+            # NOTE: Compute features
+            feat = self._get_features(images)
+            if upsample:
+                # NOTE: Transform feature to higher resolution either using `interpolate` or `FeatUp`
+                feat = self._interpolate(feat, images)
+
+        # NOTE: Features leave the autocast region in full precision, e.g. `grid_sample` in `warp_image` requires
+        # matching dtypes
+        feat = feat.float()
+
+        return (feat, )
+
+    def _predict_point_maps(
+        self, 
+        img1: Float[Tensor, "b c h w"], 
+        img2: Float[Tensor, "b c h w"]
+    ) -> Tuple[
+            Float[Tensor, "b 2 h w 3"], 
+            Float[Tensor, "b 2 h w"]
+        ]:
+        view1 = {"img": img1, "instance": [""]}
+        view2 = {"img": img2, "instance": [""]}
+        with torch.autocast("cuda", dtype=self.autocast_dtype, enabled=self.autocast_dtype is not None):
+            pred1, pred2 = self.backbone_model(view1, view2)
+
+        # NOTE: Point maps are used for rasterization which requires full precision
+        ptmps = torch.stack([pred1["pts3d"], pred2["pts3d_in_other_view"]], dim=1).detach().float()
+        conf = torch.stack([pred1["conf"], pred2["conf"]], dim=1).detach().float()
+
+        return ptmps, conf
+
     def set_rasterizer(
         self,
         image_size, 
-        points_per_pixel=10,
-        bin_size=0,
+        points_per_pixel=4,
+        bin_size=None,
         **kwargs
     ) -> None:
         raster_settings = PointsRasterizationSettings(
@@ -227,38 +648,58 @@ class MEt3R(Module):
     def render(
         self, 
         point_clouds: Pointclouds, 
+        features: Optional[Float[Tensor, "p c"]] = None,
+        feature_index: Optional[Int[Tensor, "p"]] = None,
+        return_zbuf: bool = False,
         **kwargs
     ) -> Tuple[
             Float[Tensor, "b h w c"], 
-            Float[Tensor, "b 2 h w n"]
+            Optional[Float[Tensor, "b h w n"]],
+            Int[Tensor, "b h w n"]
         ]:
         """Adoped from Pytorch3D https://pytorch3d.readthedocs.io/en/latest/modules/renderer/points/renderer.html
 
         Args:
             point_clouds (pytorch3d.structures.PointCloud): Point cloud object to render 
+            features (Float[Tensor, "p c"], optional): Features to composite instead of the packed point cloud features
+            feature_index (Int[Tensor, "p"], optional): Row of `features` for each packed point. Defaults to None.
+            return_zbuf (bool, optional): Return the z-buffer, otherwise it is released right after compositing. Defaults to False.
 
         Returns:
             images (Float[Tensor, "b h w c"]): Rendered images
-            zbuf (Float[Tensor, "b k h w n"]): Z-buffers for points per pixel
+            zbuf (Float[Tensor, "b h w n"], optional): Z-buffers for points per pixel if `return_zbuf` is set
+            idx (Int[Tensor, "b h w n"]): Packed indices of points per pixel, -1 where no point is rasterized
         """
+        background_color = kwargs.pop("background_color", None)
+        # NOTE: Rasterization requires full precision and is kept out of any surrounding autocast region
         with torch.autocast("cuda", enabled=False):
             fragments = self.rasterizer(point_clouds, **kwargs)
 
+        features = point_clouds.features_packed() if features is None else features
         r = self.rasterizer.raster_settings.radius
-
-        dists2 = fragments.dists.permute(0, 3, 1, 2)
-        weights = 1 - dists2 / (r * r)
-        images = self.compositor(
-            fragments.idx.long().permute(0, 3, 1, 2),
-            weights,
-            point_clouds.features_packed().permute(1, 0),
-            **kwargs,
-        )
-
-        # permute so image comes at the end
-        images = images.permute(0, 2, 3, 1)
-
-        return images, fragments.zbuf
+        if self.use_compile:
+            images = self._composite(fragments.idx, fragments.dists, features, r, feature_index)
+        else:
+            idx = fragments.idx.long()
+            if feature_index is not None:
+                idx = torch.where(idx >= 0, feature_index[idx.clamp_min(0)], -1)
+
+            dists2 = fragments.dists.permute(0, 3, 1, 2)
+            weights = 1 - dists2 / (r * r)
+            images = self.compositor(
+                idx.permute(0, 3, 1, 2),
+                weights,
+                features.permute(1, 0),
+            )
+
+            # permute so image comes at the end
+            images = images.permute(0, 2, 3, 1)
+
+        if background_color is not None:
+            background = images.new_tensor(background_color)
+            images = torch.where(fragments.idx[..., :1] < 0, background, images)
+
+        return images, fragments.zbuf if return_zbuf else None, fragments.idx
     
     def warp_image(self, image: torch.Tensor, flow: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
         """
@@ -325,12 +766,7 @@ class MEt3R(Module):
         return_overlap_mask: bool=False, 
         return_score_map: bool=False, 
         return_projections: bool=False
-    ) -> Tuple[
-            float, 
-            Bool[Tensor, "b h w"] | None, 
-            Float[Tensor, "b h w"] | None, 
-            Float[Tensor, "b 2 c h w"] | None
-        ]:
+    ) -> MEt3ROutput:
         
         """Forward function to compute MET3R
         Args:
@@ -340,127 +776,129 @@ class MEt3R(Module):
             return_projections (bool, False): Return projected feature maps
 
         Return:
-            score (Float[Tensor, "b"]): MET3R score which consists of weighted mean of feature dissimlarity
-            mask (bool[Tensor, "b c h w"], optional): Overlapping mask
-            feat_dissim_maps (bool[Tensor, "b h w"], optional): Feature dissimilarity score map
-            proj_feats (bool[Tensor, "b h w c"], optional): Projected and rendered features
+            outputs (MEt3ROutput): Named tuple of the MET3R score and, if requested, the overlapping mask, 
+                the feature dissimilarity score map and the projected features. Outputs not requested are None.
         """
         
         *_, h, w = images.shape
+        # NOTE: Static shapes allow for replaying captured CUDA graphs
+        graphed = self.use_cuda_graph and self.img_size is not None and images.is_cuda and not torch.is_grad_enabled()
         
-        # Set rasterization settings on the fly based on input resolution
+        # Set rasterization settings on the fly based on input resolution, cached per resolution
         if self.img_size is None:
-            raster_settings = PointsRasterizationSettings(
-                    image_size=(h, w), 
-                    radius = 0.01,
-                    points_per_pixel = 10,
-                    bin_size=0
-                )
-            self.rasterizer = PointsRasterizer(cameras=None, raster_settings=raster_settings)
+            if (h, w) not in self._rasterizers:
+                raster_settings = PointsRasterizationSettings(
+                        image_size=(h, w), 
+                        radius = 0.01,
+                        points_per_pixel = self.points_per_pixel,
+                        bin_size=self.bin_size
+                    )
+                self._rasterizers[(h, w)] = PointsRasterizer(cameras=None, raster_settings=raster_settings)
+            self.rasterizer = self._rasterizers[(h, w)]
 
         
         b, k, *_ = images.shape
-        images = rearrange(images, "b k c h w -> (b k) c h w")
-        images = (images + 1) / 2
+        # NOTE: Nearest upsampled features are gathered per point during compositing instead of being materialized
+        gather_features = self.distance == "cosine" and self.upsampler == "nearest" and self.backbone != "raft"
 
+        # NOTE: Images stay in [-1, 1] for the backbone and are only rescaled to [0, 1] where needed
         if self.distance == "cosine":
-            # NOTE: Compute features
-            lr_feat = self._get_features(images)
-            # NOTE: Transform feature to higher resolution either using `interpolate` or `FeatUp`
-            hr_feat = self._interpolate(lr_feat, images)
-            # K=2 since we only compare an image pairs
-            hr_feat = rearrange(hr_feat, "(b k) ... -> b k ...", k=2)
-        images = rearrange(images, "(b k) ... -> b k ...", k=2)
-        images = 2 * images - 1
+            # NOTE: Channels last layout allows flattening features per pixel without a copy
+            images_cl = ((images + 1) / 2).flatten(0, 1).contiguous(memory_format=torch.channels_last)
+            compute_features = functools.partial(self._compute_features, upsample=not gather_features)
+            if graphed:
+                hr_feat, = self._run_graphed("features", compute_features, images_cl)
+            else:
+                hr_feat, = compute_features(images_cl)
+            # NOTE: Features are kept as (b k) c h w, K=2 since we only compare an image pairs
+            hr_feat = hr_feat.contiguous(memory_format=torch.channels_last)
 
         # NOTE: Apply Backbone MASt3R/DUSt3R/RAFT to warp one view to the other and compute overlap masks
         if self.backbone == "raft":
             flow = self.backbone_model(images[:, 0, ...], images[:, 1, ...])[-1]
 
             if self.distance == "cosine":
-                view1 = hr_feat[:, 0, ...]
-                view2 = hr_feat[:, 1, ...]
+                view1, view2 = hr_feat.unflatten(0, (b, 2)).unbind(1)
             else:
                 view1 = images[:, 0, ...]
                 view2 = images[:, 1, ...]
 
             warped_view, mask = self.warp_image(view2, flow)
+            # NOTE: Masks are (b h w) for all backbones
+            mask = mask[:, 0]
             rendering = torch.stack([view1, warped_view], dim=1)
 
         else:
-            view1 = {"img": images[:, 0, ...], "instance": [""]}
-            view2 = {"img": images[:, 1, ...], "instance": [""]}
-            pred1, pred2 = self.backbone_model(view1, view2)
-
-            ptmps = torch.stack([pred1["pts3d"], pred2["pts3d_in_other_view"]], dim=1).detach()
-            conf = torch.stack([pred1["conf"], pred2["conf"]], dim=1).detach()
+            ptmps, conf = self._predict_point_maps(images[:, 0, ...], images[:, 1, ...])
 
             # NOTE: Get canonical point map using the confidences
-            confs11 = conf.unsqueeze(-1) - 0.999
-            canon = (confs11 * ptmps).sum(1) / confs11.sum(1)
-            
-            # Define principal point
-            pp = torch.tensor([w /2 , h / 2], device=canon.device)
-            
+            canon = self._canonical_point_map(ptmps, conf)
             
             # NOTE: Estimating fx and fy for a given canonical point map
             B, H, W, THREE = canon.shape
             assert THREE == 3
 
             # centered pixel grid
-            pixels = xy_grid(W, H, device=canon.device).view(1, -1, 2) - pp.view(-1, 1, 2)  # B,HW,2
+            if self.img_size is not None and H == W == self.img_size:
+                pixels = self._pixels
+            else:
+                pixels = centered_pixel_grid(H, W, device=canon.device)  # 1,HW,2
             canon = canon.flatten(1, 2)  # (B, HW, 3)
 
             # direct estimation of focal
-            u, v = pixels.unbind(dim=-1)
-            x, y, z = canon.unbind(dim=-1)
-            fx_votes = (u * z) / x
-            fy_votes = (v * z) / y
-
-            # assume square pixels, hence same focal for X and Y
-            f_votes = torch.stack((fx_votes.view(B, -1), fy_votes.view(B, -1)), dim=-1)
-            focal = torch.nanmedian(f_votes, dim=-2)[0]
+            focal = estimate_focal(canon, pixels)  # (B, 2)
             
             # Normalized focal length
             focal[..., 0] = 1 + focal[..., 0]/w
             focal[..., 1] = 1 + focal[..., 1]/h
             focal = repeat(focal, "b c -> (b k) c", k=2)
             # NOTE: Unproject feature on the point cloud
-            ptmps = rearrange(ptmps, "b k h w c -> (b k) (h w) c", b=b, k=2)
-            if self.distance == "cosine":
-                features = rearrange(hr_feat, "b k c h w -> (b k) (h w) c", k=2)
+            ptmps = ptmps.flatten(0, 1).flatten(1, 2)
+            render_features, feature_index = None, None
+            if gather_features:
+                # NOTE: Points look up their low resolution features at compositing time
+                features = None
+                render_features = hr_feat.flatten(2).transpose(1, 2).flatten(0, 1)
+                feature_index = nearest_feature_index(b * 2, H, W, *hr_feat.shape[-2:], device=ptmps.device)
+            elif self.distance == "cosine":
+                features = hr_feat.flatten(2).transpose(1, 2)
 
             else:
-                images = (images + 1) / 2
-                features = rearrange(images, "b k c h w-> (b k) (h w) c", k=2)
-            point_cloud = Pointclouds(points=ptmps, features=features)
+                features = rearrange((images + 1) / 2, "b k c h w-> (b k) (h w) c", k=2)
+
+            if self.conf_threshold is not None:
+                # NOTE: Drop low confidence points before rasterization, features are passed in packed order
+                keep = conf.flatten(0, 1).flatten(1, 2) > self.conf_threshold
+                point_cloud, kept_features, feature_index = drop_points(ptmps, keep, features, feature_index)
+                if not gather_features:
+                    render_features = kept_features
+            else:
+                point_cloud = EquisizedPointclouds(points=ptmps, features=features)
             
             # NOTE: Project and Render
-            R = torch.eye(3)
-            R[0, 0] *= -1
-            R[1, 1] *= -1
-            R = repeat(R, "... -> (b k) ...", b=b, k=2)
-            T = torch.zeros((3, ))
-            T = repeat(T, "... -> (b k) ...", b=b, k=2)
+            R = self._R_flip.expand(b * 2, 3, 3)
+            T = self._T0.expand(b * 2, 3)
 
             # Define Pytorch3D camera for projection
             cameras = PerspectiveCameras(device=ptmps.device, R=R, T=T, focal_length=focal)
             # Render via point rasterizer to get projected features
-            with torch.autocast("cuda", enabled=False):
-                rendering, zbuf = self.render(point_cloud, cameras=cameras, background_color=[-10000] * features.shape[-1])
+            rendering, _, idx = self.render(
+                point_cloud, 
+                features=render_features, 
+                feature_index=feature_index, 
+                return_zbuf=False, 
+                cameras=cameras
+            )
             rendering = rearrange(rendering, "(b k) h w c -> b k c h w",  b=b, k=2)
             
-            # Compute overlapping mask
-            non_overlap_mask = (rendering == -10000)
-            overlap_mask = (1 - non_overlap_mask.float()).prod(2).prod(1)
-            
-            # Zero out regions which do not overlap
-            rendering[non_overlap_mask] = 0.0
+            # Compute overlapping mask from pixels hit by at least one point in both views
+            # NOTE: Regions which do not overlap are already zero after compositing
+            overlap_mask = rearrange(idx[..., 0] >= 0, "(b k) h w -> b k h w", b=b, k=2).all(dim=1).float()
 
             # Mask for weighted sum
             mask = overlap_mask
 
-        # NOTE: Uncomment for incorporating occlusion masks along with overlap mask
+        # NOTE: Uncomment for incorporating occlusion masks along with overlap mask, requires `return_zbuf=True` in `render`
         # zbuf = rearrange(zbuf, "(b k) ... -> b k ...",  b=b, k=2)
         # closest_z = zbuf[..., 0]
         # diff = (closest_z[:, 0, ...] - closest_z[:, 1, ...]).abs()
@@ -469,15 +907,10 @@ class MEt3R(Module):
         # NOTE: Compute scores as either feature dissimilarity, RMSE, LPIPS, SSIM, MSE, or PSNR 
         score_map, weighted = self._distance(rendering[:, 0, ...], rendering[:, 1, ...], mask=mask)
 
-        outputs = [weighted]
-        if return_overlap_mask:
-            outputs.append(mask)
-            
-        if return_score_map:
-            outputs.append(score_map)
-        
-        if return_projections:
-            outputs.append(rendering)
-
-        return (*outputs, )
+        return MEt3ROutput(
+            score=weighted,
+            overlap_mask=mask if return_overlap_mask else None,
+            score_map=score_map if return_score_map else None,
+            projections=rendering if return_projections else None,
+        )
 
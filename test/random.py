@@ -11,7 +11,7 @@ class MET3RTest(unittest.TestCase):
     def random_inputs(self):
         inputs = torch.randn((10, 2, 3, 256, 256)).cuda()
         inputs = inputs.clip(-1, 1)
-        score, mask = self.metric(inputs)
+        score, mask, *_ = self.metric(inputs, return_overlap_mask=True)
 
         self.assertTrue(0.3 <= score <= 0.35)
 
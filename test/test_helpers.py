@@ -0,0 +1,253 @@
+import torch
+import unittest
+
+from collections import OrderedDict
+
+from torch.nn import Identity, Module, functional as F
+from pytorch3d.structures import Pointclouds
+from pytorch3d.renderer import AlphaCompositor, PerspectiveCameras
+
+from met3r.met3r import (
+    MEt3R,
+    canonical_point_map,
+    centered_pixel_grid,
+    composite_points,
+    cosine_score,
+    drop_points,
+    EquisizedPointclouds,
+    estimate_focal,
+    nearest_feature_index,
+)
+
+
+def make_renderer(use_compile: bool, image_size: int = 32, radius: float = 0.05) -> MEt3R:
+    # NOTE: Only the rendering state of MET3R is set up, which avoids loading any pretrained weights
+    renderer = MEt3R.__new__(MEt3R)
+    Module.__init__(renderer)
+    renderer.use_compile = use_compile
+    renderer._composite = composite_points
+    renderer.compositor = AlphaCompositor()
+    renderer.set_rasterizer(image_size=image_size, points_per_pixel=4, bin_size=0, radius=radius)
+
+    return renderer
+
+
+class HelpersTest(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+
+    def random_point_cloud(self, n: int = 2, p: int = 300, c: int = 8):
+        xy = torch.rand((n, p, 2)) * 2 - 1
+        z = torch.rand((n, p, 1)) * 2 + 1
+        # Points cover only part of the image to leave background pixels
+        points = torch.cat([xy * z * 0.7, z], dim=-1)
+        features = torch.rand((n, p, c))
+
+        return points, features
+
+    def test_composite_points(self):
+        n, h, w, k, p, c = 2, 8, 8, 4, 50, 5
+        radius = 0.1
+        idx = torch.randint(0, p, (n, h, w, k))
+        dists = (torch.rand((n, h, w, k)) * radius * radius).sort(-1).values
+        # Like the rasterizer, empty slots are trailing and marked with -1
+        num_valid = torch.randint(0, k + 1, (n, h, w, 1))
+        empty = torch.arange(k) >= num_valid
+        idx = idx.masked_fill(empty, -1)
+        dists = dists.masked_fill(empty, -1)
+        features = torch.rand((p, c))
+
+        images = composite_points(idx, dists, features, radius)
+        reference = AlphaCompositor()(
+            idx.permute(0, 3, 1, 2),
+            1 - dists.permute(0, 3, 1, 2) / (radius * radius),
+            features.permute(1, 0),
+        ).permute(0, 2, 3, 1)
+
+        self.assertTrue(torch.allclose(images, reference, atol=1e-5))
+
+    def test_render(self):
+        points, features = self.random_point_cloud()
+        point_cloud = Pointclouds(points=points, features=features)
+        cameras = PerspectiveCameras(R=torch.eye(3)[None].expand(2, 3, 3), T=torch.zeros(2, 3))
+        background_color = torch.rand(features.shape[-1]).tolist()
+
+        renderer = make_renderer(use_compile=False)
+        fragments = renderer.rasterizer(point_cloud, cameras=cameras)
+        radius = renderer.rasterizer.raster_settings.radius
+        reference = AlphaCompositor(background_color=background_color)(
+            fragments.idx.long().permute(0, 3, 1, 2),
+            1 - fragments.dists.permute(0, 3, 1, 2) / (radius * radius),
+            point_cloud.features_packed().permute(1, 0),
+        ).permute(0, 2, 3, 1)
+        self.assertTrue((fragments.idx[..., 0] < 0).any())
+
+        for use_compile in [False, True]:
+            renderer = make_renderer(use_compile=use_compile)
+            images, zbuf, idx = renderer.render(point_cloud, cameras=cameras, background_color=background_color)
+
+            self.assertIsNone(zbuf)
+            self.assertTrue(torch.equal(idx, fragments.idx))
+            self.assertTrue(torch.allclose(images, reference, atol=1e-5))
+
+    def test_equisized_pointclouds(self):
+        points, features = self.random_point_cloud(n=3, p=100)
+        point_cloud = EquisizedPointclouds(points=points, features=features)
+        reference = Pointclouds(points=points, features=features)
+
+        self.assertTrue(torch.equal(point_cloud.points_packed(), reference.points_packed()))
+        self.assertTrue(torch.equal(point_cloud.features_packed(), reference.features_packed()))
+        self.assertIsNone(point_cloud.normals_packed())
+        self.assertTrue(torch.equal(point_cloud.packed_to_cloud_idx(), reference.packed_to_cloud_idx()))
+        self.assertTrue(torch.equal(point_cloud.cloud_to_packed_first_idx(), reference.cloud_to_packed_first_idx()))
+        self.assertTrue(torch.equal(point_cloud.num_points_per_cloud(), reference.num_points_per_cloud()))
+        self.assertTrue(torch.equal(point_cloud.padded_to_packed_idx(), reference.padded_to_packed_idx()))
+
+    def test_canonical_point_map(self):
+        ptmps = torch.randn((2, 2, 8, 8, 3))
+        conf = torch.rand((2, 2, 8, 8)) * 5 + 1
+
+        confs11 = conf.unsqueeze(-1) - 0.999
+        reference = (confs11 * ptmps).sum(1) / confs11.sum(1)
+
+        self.assertTrue(torch.allclose(canonical_point_map(ptmps, conf), reference, atol=1e-6))
+
+    def test_nearest_feature_index(self):
+        n, c = 2, 6
+        for lr_h, lr_w, h, w in [(16, 16, 256, 256), (14, 14, 224, 224), (24, 20, 256, 256), (16, 32, 32, 16)]:
+            lr_feat = torch.rand((n, c, lr_h, lr_w))
+            reference = F.interpolate(lr_feat, (h, w), mode="nearest").flatten(2).transpose(1, 2).flatten(0, 1)
+            index = nearest_feature_index(n, h, w, lr_h, lr_w)
+            feat = lr_feat.flatten(2).transpose(1, 2).flatten(0, 1)[index]
+
+            self.assertTrue(torch.equal(feat, reference))
+
+    def test_render_feature_index(self):
+        points, _ = self.random_point_cloud()
+        point_cloud = Pointclouds(points=points)
+        cameras = PerspectiveCameras(R=torch.eye(3)[None].expand(2, 3, 3), T=torch.zeros(2, 3))
+        features = torch.rand((20, 8))
+        feature_index = torch.randint(0, 20, (points.shape[0] * points.shape[1], ))
+
+        for use_compile in [False, True]:
+            renderer = make_renderer(use_compile=use_compile)
+            images, *_ = renderer.render(point_cloud, features=features, feature_index=feature_index, cameras=cameras)
+            reference, *_ = renderer.render(point_cloud, features=features[feature_index], cameras=cameras)
+
+            self.assertTrue(torch.allclose(images, reference, atol=1e-6))
+
+    def test_cosine_score_weighted(self):
+        inp1 = torch.randn((2, 16, 8, 8))
+        inp2 = torch.randn((2, 16, 8, 8))
+        mask = (torch.rand((2, 8, 8)) > 0.5).float()
+        eps = 1e-5
+
+        score_map, weighted = cosine_score(inp1, inp2, mask, eps)
+        reference = (score_map * mask).sum((-2, -1)) / (mask.sum((-2, -1)) + eps)
+        self.assertEqual(weighted.shape, (2, ))
+        self.assertTrue(torch.allclose(weighted, reference, atol=1e-6))
+
+        unmasked_score_map, weighted = cosine_score(inp1, inp2, eps=eps)
+        self.assertTrue(torch.allclose(unmasked_score_map, score_map))
+        self.assertIsNone(weighted)
+
+    def test_cosine_score(self):
+        inp1 = torch.randn((2, 16, 8, 8))
+        inp2 = torch.randn((2, 16, 8, 8))
+        eps = 1e-5
+
+        norm = torch.linalg.norm(inp1, dim=1) * torch.linalg.norm(inp2, dim=1)
+        reference = 1 - (inp1 * inp2).sum(1) / (norm + eps)
+
+        score_map, _ = cosine_score(inp1, inp2, eps=eps)
+        self.assertTrue(torch.allclose(score_map, reference, atol=1e-5))
+
+    def test_warp_mask_score(self):
+        metric = MEt3R.__new__(MEt3R)
+        Module.__init__(metric)
+        metric.distance = "cosine"
+        metric._cosine_score = cosine_score
+        feat1 = torch.randn((3, 16, 8, 8))
+        feat2 = torch.randn((3, 16, 8, 8))
+
+        warped, mask = metric.warp_image(feat2, torch.zeros((3, 2, 8, 8)))
+        # Same as the raft branch of `forward`
+        score_map, weighted = metric._distance(feat1, warped, mask=mask[:, 0])
+
+        self.assertEqual(score_map.shape, (3, 8, 8))
+        self.assertEqual(weighted.shape, (3, ))
+
+    @unittest.skipUnless(torch.cuda.is_available(), "requires CUDA")
+    def test_run_graphed(self):
+        metric = MEt3R.__new__(MEt3R)
+        Module.__init__(metric)
+        metric.upsampler = "bilinear"
+        metric.feature_dtype = None
+        metric.norm = Identity()
+        metric.feature_model = torch.nn.Conv2d(3, 8, kernel_size=4, stride=4).cuda().eval()
+        metric.max_cuda_graphs = 1
+        metric._cuda_graphs = OrderedDict()
+
+        with torch.no_grad():
+            for shape in [(4, 3, 32, 32), (4, 3, 32, 32), (2, 3, 32, 32)]:
+                images = torch.rand(shape, device="cuda")
+                feat, = metric._run_graphed("features", metric._compute_features, images)
+                reference, = metric._compute_features(images)
+
+                self.assertTrue(torch.allclose(feat, reference, atol=1e-5))
+                self.assertEqual(len(metric._cuda_graphs), 1)
+
+    def test_estimate_focal(self):
+        h, w = 8, 12
+        focal = torch.tensor([[300.0, 250.0], [120.0, 130.0]])
+        pixels = centered_pixel_grid(h, w)
+        z = torch.rand((2, h * w, 1)) * 2 + 1
+        pts3d = torch.cat([pixels * z / focal[:, None], z], dim=-1)
+        # Points on the camera plane are ignored
+        pts3d[:, 0] = torch.tensor([1.0, 1.0, 0.0])
+        pts3d[:, 1] = 0.0
+
+        self.assertTrue(torch.allclose(estimate_focal(pts3d, pixels), focal, rtol=1e-4))
+
+    def test_drop_points(self):
+        n, p = 3, 300
+        points, features = self.random_point_cloud(n=n, p=p)
+        keep = torch.rand((n, p)) > 0.5
+        # Every point of one cloud is dropped
+        keep[1] = False
+        cameras = PerspectiveCameras(R=torch.eye(3)[None].expand(n, 3, 3), T=torch.zeros(n, 3))
+        lr_features = torch.rand((20, 8))
+        feature_index = torch.randint(0, 20, (n * p, ))
+
+        point_cloud, kept_features, kept_feature_index = drop_points(points, keep, features, feature_index)
+        reference_cloud = Pointclouds(
+            points=[points[i][keep[i]] for i in range(n)], 
+            features=[features[i][keep[i]] for i in range(n)]
+        )
+        gathered_cloud = Pointclouds(
+            points=[points[i][keep[i]] for i in range(n)], 
+            features=[lr_features[feature_index.view(n, p)[i][keep[i]]] for i in range(n)]
+        )
+        self.assertTrue(torch.equal(point_cloud.num_points_per_cloud(), keep.sum(1)))
+
+        for use_compile in [False, True]:
+            renderer = make_renderer(use_compile=use_compile)
+            reference, _, reference_idx = renderer.render(reference_cloud, cameras=cameras)
+            images, _, idx = renderer.render(point_cloud, features=kept_features, cameras=cameras)
+            self.assertTrue(torch.equal(idx, reference_idx))
+            self.assertTrue(torch.allclose(images, reference, atol=1e-6))
+            self.assertTrue((idx[1] < 0).all())
+
+            reference, *_ = renderer.render(gathered_cloud, cameras=cameras)
+            images, *_ = renderer.render(
+                point_cloud, 
+                features=lr_features, 
+                feature_index=kept_feature_index, 
+                cameras=cameras
+            )
+            self.assertTrue(torch.allclose(images, reference, atol=1e-6))
+
+
+if __name__ == '__main__':
+    unittest.main()